@@ -1,24 +1,28 @@
 # src/check_output.py
 from pathlib import Path
-from utils import create_spark, log
+
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from utils import log
 
 def main():
     project_root = Path(__file__).resolve().parents[1]
     path = project_root / "output" / "final_cleaned_stock_parquet"
 
-    spark = create_spark("CheckOutput")
-    df = spark.read.parquet(str(path))
+    # Plain Arrow scan, these checks do not need a Spark session
+    dataset = ds.dataset(str(path), format="parquet", partitioning="hive")
 
-    log(f"row count: {df.count()}")
+    log(f"row count: {dataset.count_rows()}")
     log("schema:")
-    df.printSchema()
+    print(dataset.schema)
 
     log("sample rows:")
-    df.show(10, truncate=False)
+    print(dataset.head(10).to_pandas().to_string(index=False))
 
-    if "ItemCode" in df.columns and "WhsCode" in df.columns:
-        uniq_items = df.select("ItemCode").distinct().count()
-        uniq_whs = df.select("WhsCode").distinct().count()
+    if "ItemCode" in dataset.schema.names and "WhsCode" in dataset.schema.names:
+        keys = dataset.to_table(columns=["ItemCode", "WhsCode"])
+        uniq_items = pc.count_distinct(keys["ItemCode"]).as_py()
+        uniq_whs = pc.count_distinct(keys["WhsCode"]).as_py()
         log(f"distinct ItemCode: {uniq_items}")
         log(f"distinct WhsCode: {uniq_whs}")
 
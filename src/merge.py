@@ -1,9 +1,16 @@
 # src/merge.py
-from functools import reduce
 from pathlib import Path
+from typing import List
 
 from pyspark.sql import DataFrame
-from utils import create_spark, log, list_year_parquets, deduplicate_by_keys
+from utils import create_spark, log, list_year_parquets, deduplicate_by_keys, write_parquet
+
+def _balanced_union(dfs: List[DataFrame]) -> DataFrame:
+    """unionByName pairwise so the plan is log2(N) deep instead of a left-deep chain."""
+    while len(dfs) > 1:
+        paired = [dfs[i].unionByName(dfs[i + 1]) for i in range(0, len(dfs) - 1, 2)]
+        dfs = paired + ([dfs[-1]] if len(dfs) % 2 else [])
+    return dfs[0]
 
 def main() -> None:
     project_root = Path(__file__).resolve().parents[1]
@@ -16,13 +23,16 @@ def main() -> None:
         return
 
     log(f"found {len(parquet_folders)} yearly parquet folders")
-    dfs = [spark.read.parquet(str(p)) for p in parquet_folders]
-    combined = reduce(DataFrame.unionByName, dfs)
+    # Each yearly folder is its own year=/month= partitioned root, and Spark refuses to discover
+    # partitions across several roots in one read, so every folder is read on its own.
+    # One writer produces them all, so the first folder's schema is reused to skip footer inference
+    first = spark.read.parquet(str(parquet_folders[0]))
+    dfs = [first] + [spark.read.schema(first.schema).parquet(str(p)) for p in parquet_folders[1:]]
+    combined = _balanced_union(dfs)
 
     deduped = deduplicate_by_keys(combined, order_col="OnHand", order_desc=True)
     out_path = output_dir / "final_cleaned_stock_parquet"
-    deduped.write.mode("overwrite").parquet(str(out_path))
-    log(f"wrote final dataset: {out_path}")
+    write_parquet(deduped.repartition("year", "month"), out_path, partition_by=("year", "month"))
 
 if __name__ == "__main__":
     main()
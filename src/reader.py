@@ -3,9 +3,10 @@ reader.py  ETL pipeline for yearly stock Excel files
 
 Usage:
     python reader.py --year 2025 --abs_jump 500 --rel_jump 5.0
+    python reader.py --year 2025 --engine pandas
 
 Requirements:
-    pandas, pyarrow, pyspark
+    pandas, pyarrow, pyspark, python-calamine
 
 Arguments:
     --year       Year of the Excel file to process
@@ -13,176 +14,302 @@ Arguments:
                  Example: 500 means any change >= 500 units vs the previous valid day is flagged
     --rel_jump   Relative day on day change threshold for outlier detection
                  Example: 5.0 means any change >= 5x vs the previous valid day is flagged
+    --engine     spark (default) or pandas; pandas skips the Spark session for a single small year
+                 and writes the same partitioned Parquet layout with PyArrow
 
 Process overview:
-    1) Use pandas to read the Excel and normalise headers and columns so the structure is consistent
-    2) Write the normalised result to a Parquet staging file to fix the schema up front
-    3) Use PySpark to read the staged Parquet and perform unpivot, type casting, filtering, deduplication,
-       and gap aware outlier and null handling using the nearest previous or next valid value
+    1) Read the Excel with calamine into pandas and normalise headers and columns so the structure is consistent
+    2) Unpivot to one row per item, warehouse and date in pandas and drop empty, DC and zero cells,
+       then hand the long frame to Spark in memory through Arrow, no staging file is written
+       Record dates are parsed once per Date column on the driver
+    3) Use PySpark to perform deduplication and gap aware outlier and null handling using the nearest previous or next valid value
        No new rows are created for missing weekdays
-    4) Write the curated result to Parquet
+    4) Write the curated result to Parquet partitioned by year and month
 """
 
 import argparse
 import re
-from functools import reduce
+import shutil
+from datetime import date, timedelta
 from pathlib import Path
+from typing import Optional, Sequence
 
+import numpy as np
 import pandas as pd
-from pyspark.sql import DataFrame
+from pandas.api.types import is_numeric_dtype
+import pyarrow as pa
+import pyarrow.dataset as ds
 from pyspark.sql import functions as F
-from pyspark.sql.functions import when, lit, col, row_number, date_format, to_date
-from pyspark.sql.window import Window
-
-from utils import create_spark, log
-
-
-def run(year: int, abs_jump: float, rel_jump: float) -> None:
-    project_root = Path(__file__).resolve().parents[1]
-    data_dir = project_root / "data"
-    output_dir = project_root / "output"
-
-    excel_path = data_dir / f"{year}.xlsx"
-    parquet_stage_path = data_dir / f"{year}_stage.parquet"
-    parquet_path = output_dir / f"cleaned_stock_parquet_{year}"
+from pyspark.sql.functions import lit
+from pyspark.sql.types import DateType, DoubleType, StringType, StructField, StructType
+from python_calamine import CalamineWorkbook
+
+from utils import create_spark, deduplicate_by_keys, log, write_parquet
+
+# Blank, pandas-generated "Unnamed" or purely numeric headers carry no warehouse or date
+_INVALID_HEADER = re.compile(r"^\s*$|^Unnamed|^\d+(\.\d+)?$")
+
+# Strings pd.read_excel treats as missing by default in pandas 1.5
+_NA_STRINGS = [
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND",
+    "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "n/a", "nan", "null",
+]
+
+# Leading yyyy-MMM-dd of a header date; anything after the day is ignored
+_RECORD_DATE = re.compile(r"^\s*(\d{1,4})-([A-Za-z]+)-(\d{1,2})")
+
+# Long frame handed from pandas to Spark, one row per item, warehouse and date
+_LONG_SCHEMA = StructType([
+    StructField("ItemCode", StringType()),
+    StructField("WhsCode", StringType()),
+    StructField("OnHand", DoubleType()),
+    StructField("RecordDate", DateType()),
+])
+
+
+def _dedupe_headers(header: list) -> list:
+    """Name blank headers Unnamed: i and suffix repeats with .1, .2 the way pandas does."""
+    names = [f"Unnamed: {i}" if h is None or h == "" else h for i, h in enumerate(header)]
+    counts: dict = {}
+    for i, name in enumerate(names):
+        cur_count = counts.get(name, 0)
+        while cur_count > 0:
+            counts[name] = cur_count + 1
+            name = f"{name}.{cur_count}"
+            cur_count = counts.get(name, 0)
+        names[i] = name
+        counts[name] = cur_count + 1
+    return names
+
+
+def _convert_cell(value):
+    """Turn a calamine cell into the value pd.read_excel would give, integral floats become int."""
+    if isinstance(value, float):
+        return int(value) if value.is_integer() else value
+    if isinstance(value, date):
+        return pd.Timestamp(value)
+    if isinstance(value, timedelta):
+        return pd.Timedelta(value)
+    return value
+
+
+def _read_excel(path: Path) -> pd.DataFrame:
+    """Read the first sheet with calamine and shape it like pd.read_excel(path, header=0)."""
+    sheet = CalamineWorkbook.from_path(str(path)).get_sheet_by_index(0)
+    rows = [[_convert_cell(v) for v in row] for row in sheet.to_python(skip_empty_area=False)]
+    # Like read_excel, trim trailing blank rows but keep blank rows inside the sheet as all-NaN
+    # rows. Their NaN decides the column dtype, e.g. integer item codes become float and
+    # stringify as "1001.0", so dropping them would change the business key
+    while rows and all(v == "" for v in rows[-1]):
+        rows.pop()
+    df = pd.DataFrame(rows[1:], columns=_dedupe_headers(rows[0]))
+    return df.replace(_NA_STRINGS, np.nan).infer_objects()
+
+
+def _parse_record_date(value) -> Optional[date]:
+    """Parse a yyyy-MMM-dd header date as leniently as Spark's legacy SimpleDateFormat did.
+
+    Short or full month names in any case are accepted, trailing text such as "(Mon)" is
+    ignored and an out of range day rolls over into the next month. Returns None when the
+    value does not parse.
+    """
+    if pd.isna(value):
+        return None
+    match = _RECORD_DATE.match(str(value))
+    if match is None:
+        return None
+    year, month_name, day = match.groups()
+    for fmt in ("%Y-%b", "%Y-%B"):
+        month_start = pd.to_datetime(f"{int(year):04d}-{month_name}", format=fmt, errors="coerce")
+        if not pd.isna(month_start):
+            return (month_start + pd.Timedelta(days=int(day) - 1)).date()
+    return None
+
+
+def _strip_spaces(df: pd.DataFrame) -> pd.DataFrame:
+    """Remove every space from non-null cells, one vectorised pass per column.
+
+    Numeric columns cannot hold spaces and are left numeric, except the item code column
+    which is always text.
+    """
+    item_col = df.columns[0]
+    return df.apply(
+        lambda s: s if s.name != item_col and is_numeric_dtype(s)
+        else s.astype(str).str.replace(" ", "", regex=False).where(s.notna())
+    )
 
-    output_dir.mkdir(parents=True, exist_ok=True)
-    data_dir.mkdir(parents=True, exist_ok=True)
 
-    # 1) Read Excel with pandas and normalise structure
+def _fill_outliers(
+    pdf: pd.DataFrame, abs_jump: float, rel_jump: float, keys: Sequence[str] = ()
+) -> pd.DataFrame:
+    """Replace outliers and nulls in each (ItemCode, WhsCode) series with the nearest valid value.
+
+    A value is an outlier when its change against the previous valid day exceeds
+    abs_jump in absolute terms or rel_jump as a ratio. It is replaced by the previous
+    valid value, or the next one when no previous value exists. Without keys the whole
+    frame is treated as a single series.
+    """
+    pdf = pdf.sort_values([*keys, "RecordDate"], na_position="first")
+    on_hand = pdf["OnHand"]
+    if keys:
+        by = [pdf[k] for k in keys]
+        prev_valid = on_hand.groupby(by).shift(1).groupby(by).ffill()
+        next_valid = on_hand.groupby(by).shift(-1).groupby(by).bfill()
+    else:
+        prev_valid = on_hand.shift(1).ffill()
+        next_valid = on_hand.shift(-1).bfill()
+
+    abs_change = (on_hand - prev_valid).abs()
+    rel_change = (abs_change / prev_valid.abs()).where(prev_valid != 0.0)
+    is_outlier = on_hand.notna() & ((abs_change > abs_jump) | (rel_change > rel_jump))
+
+    replacement = prev_valid.fillna(next_valid)
+    needs_fill = (is_outlier | on_hand.isna()) & replacement.notna()
+    pdf["OnHand"] = on_hand.mask(needs_fill, replacement)
+    return pdf
+
+
+def _excel_to_long(excel_path: Path) -> pd.DataFrame:
+    """Read a yearly workbook and return one row per (ItemCode, WhsCode, RecordDate) cell with stock."""
     log(f"reading Excel: {excel_path}")
-    df_xlsx = pd.read_excel(excel_path, header=0)
-    df_no_space = df_xlsx.applymap(lambda x: x if pd.isna(x) else str(x).replace(" ", ""))
-
-    column_names = list(df_no_space.columns)
-    valid_cols_idx = [
-        i for i, c in enumerate(column_names)
-        if i == 0
-        or (
-            isinstance(c, str)
-            and not re.match(r"^\s*$", c)
-            and not re.match(r"^Unnamed.*", c)
-            and not re.match(r"^\d+(\.\d+)?$", c)
-        )
-    ]
+    df_xlsx = _read_excel(excel_path)
+    df_no_space = _strip_spaces(df_xlsx)
+
+    # Non-string headers match as NaN and are treated as invalid, the first column is always kept
+    headers = pd.Series(df_no_space.columns, dtype="object")
+    valid_mask = ~headers.str.match(_INVALID_HEADER, na=True).astype(bool)
+    valid_mask.iloc[0] = True
+    valid_cols_idx = np.flatnonzero(valid_mask.to_numpy()).tolist()
     filtered_data = df_no_space.iloc[:, valid_cols_idx].copy()
 
     first_col = filtered_data.columns[0]
     filtered_data = filtered_data.drop_duplicates().drop_duplicates(subset=first_col, keep="first")
 
-    # Force numeric conversion on known numeric columns
-    for c in ["OnHand", "IsCommited", "OnOrder", "AvgPrice"]:
-        if c in filtered_data.columns:
-            filtered_data[c] = pd.to_numeric(filtered_data[c], errors="coerce")
+    # Record dates sit in the first row under each Date column, read them here instead of in Spark
+    filtered_data.columns = [str(c) for c in filtered_data.columns]
+    date_col_indices = [i for i, c in enumerate(filtered_data.columns) if "Date" in c]
 
-    filtered_data.to_parquet(parquet_stage_path, index=False)
-    log(f"wrote staged Parquet: {parquet_stage_path}")
-
-    # 2) Spark reads the staged Parquet and performs ETL
-    spark = create_spark(app_name=f"StockETL-{year}", driver_memory="6g", executor_memory="6g")
-    df = spark.read.parquet(str(parquet_stage_path))
-
-    all_columns = df.columns
-    date_col_indices = [i for i, c in enumerate(all_columns) if "Date" in str(c)]
-
-    reshaped = []
+    # Each date section owns the warehouse columns between the previous Date column and its own.
+    # Dates are parsed here once per section rather than once per row later on
+    sections = []
     for i, date_idx in enumerate(date_col_indices):
-        record_date = df.first()[date_idx]
+        raw_date = filtered_data.iat[0, date_idx]
+        record_date = _parse_record_date(raw_date)
         start = date_col_indices[i - 1] + 1 if i > 0 else 1
-        end = date_idx
-        wh_cols = all_columns[start:end]
-        if not wh_cols:
-            continue
-
-        tmp = df.selectExpr([f"`{all_columns[0]}`"] + [f"`{c}`" for c in wh_cols])
-        stack_expr = ", ".join([f"'{c.split('.')[0]}', `{c}`" for c in wh_cols])
-        stacked = tmp.selectExpr(
-            f"`{all_columns[0]}` as ItemCode",
-            f"stack({len(wh_cols)}, {stack_expr}) as (WhsCode, OnHand)"
-        ).withColumn("RecordDate", lit(record_date))
-        reshaped.append(stacked)
-
-    final_df = reduce(DataFrame.unionByName, reshaped)
-
-    # Basic structural cleaning
-    final_df = (
-        final_df.na.drop(subset=["ItemCode", "WhsCode", "OnHand", "RecordDate"])
-        .withColumn("ValidFor", when(col("OnHand") == "DC", "N").otherwise("Y"))
-        .filter(col("OnHand") != "DC")
-        .withColumn("OnHand", col("OnHand").cast("double"))
-        .filter(col("OnHand") != 0.0)
-        .withColumn("IsCommited", lit(0.0))
-        .withColumn("OnOrder", lit(0.0))
-        .withColumn("AvgPrice", lit(0.0))
-    )
-
-    # Remove duplicates on the business key
-    w_dup_key = (
-        Window
-        .partitionBy("ItemCode", "WhsCode", "RecordDate")
-        .orderBy(F.col("OnHand").desc_nulls_last())
+        wh_cols = list(filtered_data.columns[start:date_idx])
+        if record_date is None:
+            log(
+                f"warning: {filtered_data.columns[date_idx]} value {raw_date!r} is not a yyyy-MMM-dd date, "
+                f"dropping its {len(wh_cols)} warehouse columns"
+            )
+        sections.append((record_date, wh_cols))
+
+    # Wide-to-long in pandas: one row per (item, warehouse column) cell. A column-major ravel of the
+    # value block stacks whole columns in value_cols order, so each row's source column is a plain
+    # repeat and its item a tile of the item column
+    item_col = filtered_data.columns[0]
+    value_cols = [c for _, wh_cols in sections for c in wh_cols]
+    n_rows = len(filtered_data)
+    source_idx = np.repeat(np.arange(len(value_cols)), n_rows)
+    values = filtered_data[value_cols].to_numpy(dtype=object).ravel("F")
+    items = np.tile(filtered_data[item_col].to_numpy(dtype=object), len(value_cols))
+
+    # Resolve WhsCode and RecordDate once per source column and take them by position
+    whs_codes = np.array([c.split(".")[0] for c in value_cols], dtype=object)
+    col_dates = np.array([record_date for record_date, wh_cols in sections for _ in wh_cols], dtype=object)
+
+    # Force numeric conversion on stock values; "DC", other non-numeric markers and zero stock become null
+    return pd.DataFrame({
+        "ItemCode": items,
+        "WhsCode": whs_codes[source_idx],
+        "OnHand": pd.to_numeric(pd.Series(values), errors="coerce").replace(0.0, np.nan),
+        "RecordDate": col_dates[source_idx],
+    }).dropna()
+
+
+def _run_pandas(long_df: pd.DataFrame, parquet_path: Path, abs_jump: float, rel_jump: float) -> None:
+    """Finish a single year in pandas and write the same partitioned Parquet layout as Spark."""
+    # Remove duplicates on the business key, keeping the row with the highest OnHand
+    df = long_df.sort_values("OnHand", ascending=False).drop_duplicates(["ItemCode", "WhsCode", "RecordDate"])
+
+    # Datetime dtype for sorting and the year/month partition columns
+    df = df.assign(RecordDate=pd.to_datetime(df["RecordDate"]))
+
+    # Gap aware outlier and null handling, all series at once
+    df = _fill_outliers(df, abs_jump, rel_jump, keys=("ItemCode", "WhsCode"))
+
+    df_cleaned = pd.DataFrame({
+        "ItemCode": df["ItemCode"],
+        "WhsCode": df["WhsCode"],
+        "OnHand": df["OnHand"],
+        "IsCommited": 0.0,
+        "OnOrder": 0.0,
+        "AvgPrice": 0.0,
+        "ValidFor": "Y",
+        "RecordDate": df["RecordDate"].dt.date,
+        "year": df["RecordDate"].dt.year.astype("Int32"),
+        "month": df["RecordDate"].dt.month.astype("Int32"),
+    })
+
+    # Mirror Spark's overwrite mode: replace the whole output folder
+    shutil.rmtree(parquet_path, ignore_errors=True)
+    ds.write_dataset(
+        pa.Table.from_pandas(df_cleaned, preserve_index=False),
+        str(parquet_path),
+        format="parquet",
+        partitioning=["year", "month"],
+        partitioning_flavor="hive",
+        file_options=ds.ParquetFileFormat().make_write_options(compression="zstd"),
+        max_rows_per_group=1_000_000,
     )
-    final_df = final_df.withColumn("row_num", row_number().over(w_dup_key)).filter(col("row_num") == 1).drop("row_num")
+    log(f"written parquet to {parquet_path}")
 
-    # Standardise date
-    final_df = final_df.withColumn(
-        "RecordDate",
-        date_format(to_date("RecordDate", "yyyy-MMM-dd"), "yyyy-MM-dd")
-    ).withColumn("RecordDate", F.to_date("RecordDate", "yyyy-MM-dd"))
 
-    # 3) Gap aware outlier and null handling on existing records only
-    key_cols = ["ItemCode", "WhsCode"]
-    w_ord = Window.partitionBy(*key_cols).orderBy("RecordDate")
+def run(year: int, abs_jump: float, rel_jump: float, engine: str = "spark") -> None:
+    project_root = Path(__file__).resolve().parents[1]
+    data_dir = project_root / "data"
+    output_dir = project_root / "output"
 
-    prev_non_null = F.last("OnHand", ignorenulls=True).over(
-        w_ord.rowsBetween(Window.unboundedPreceding, -1)
-    )
-    next_non_null = F.first("OnHand", ignorenulls=True).over(
-        w_ord.rowsBetween(1, Window.unboundedFollowing)
-    )
+    excel_path = data_dir / f"{year}.xlsx"
+    parquet_path = output_dir / f"cleaned_stock_parquet_{year}"
 
-    abs_change = F.when(prev_non_null.isNotNull(), F.abs(F.col("OnHand") - prev_non_null))
-    rel_change = F.when(
-        prev_non_null.isNotNull() & (prev_non_null != 0.0),
-        F.abs((F.col("OnHand") - prev_non_null) / prev_non_null)
-    )
+    output_dir.mkdir(parents=True, exist_ok=True)
+    data_dir.mkdir(parents=True, exist_ok=True)
 
-    is_outlier = F.when(
-        F.col("OnHand").isNotNull() & (
-            (abs_change.isNotNull() & (abs_change > F.lit(abs_jump))) |
-            (rel_change.isNotNull() & (rel_change > F.lit(rel_jump)))
-        ),
-        F.lit(True)
-    ).otherwise(F.lit(False))
-
-    filled_onhand = (
-        F.when(is_outlier & prev_non_null.isNotNull(), prev_non_null)
-         .when(is_outlier & prev_non_null.isNull() & next_non_null.isNotNull(), next_non_null)
-         .when(F.col("OnHand").isNull() & prev_non_null.isNotNull(), prev_non_null)
-         .when(F.col("OnHand").isNull() & prev_non_null.isNull() & next_non_null.isNotNull(), next_non_null)
-         .otherwise(F.col("OnHand"))
-    )
+    # 1) Read Excel with pandas, normalise structure and unpivot
+    long_df = _excel_to_long(excel_path)
+    if engine == "pandas":
+        _run_pandas(long_df, parquet_path, abs_jump, rel_jump)
+        return
 
-    df_cleaned = (
-        final_df
-        .withColumn("OnHand", filled_onhand)
-        .withColumn("IsCommited", F.coalesce("IsCommited", F.lit(0.0)))
-        .withColumn("OnOrder",   F.coalesce("OnOrder",   F.lit(0.0)))
-        .withColumn("AvgPrice",  F.coalesce("AvgPrice",  F.lit(0.0)))
-        .withColumn("ValidFor",  F.coalesce("ValidFor",  F.lit("Y")))
-    )
+    # 2) Hand the long frame to Spark in memory, Arrow moves it column by column
+    spark = create_spark(app_name=f"StockETL-{year}", driver_memory="6g", executor_memory="6g")
+    final_df = spark.createDataFrame(long_df, schema=_LONG_SCHEMA)
 
-    # Safety dedup after replacements
-    w_final = Window.partitionBy(*key_cols, "RecordDate").orderBy(F.col("OnHand").desc_nulls_last())
-    df_cleaned = df_cleaned.withColumn("rn", row_number().over(w_final)).filter(col("rn") == 1).drop("rn")
+    # Remove duplicates on the business key, keeping the row with the highest OnHand
+    final_df = deduplicate_by_keys(final_df, order_col="OnHand", order_desc=True)
 
-    # 4) Select columns and write curated Parquet
-    df_cleaned = df_cleaned.select(
-        "ItemCode", "WhsCode", "OnHand", "IsCommited", "OnOrder", "AvgPrice", "ValidFor", "RecordDate"
+    # 3) Gap aware outlier and null handling on existing records only, one pandas batch per key
+    key_cols = ["ItemCode", "WhsCode"]
+    filled = final_df.groupBy(*key_cols).applyInPandas(
+        lambda pdf: _fill_outliers(pdf, abs_jump, rel_jump), schema=final_df.schema
     )
 
-    df_cleaned.write.mode("overwrite").parquet(str(parquet_path))
-    log(f"wrote curated Parquet: {parquet_path}")
+    # 4) Add the default columns in one projection and write curated Parquet,
+    # partitioned by year and month so downstream readers can prune files
+    df_cleaned = filled.select(
+        "ItemCode",
+        "WhsCode",
+        "OnHand",
+        lit(0.0).alias("IsCommited"),
+        lit(0.0).alias("OnOrder"),
+        lit(0.0).alias("AvgPrice"),
+        lit("Y").alias("ValidFor"),
+        "RecordDate",
+        F.year("RecordDate").alias("year"),
+        F.month("RecordDate").alias("month"),
+    )
+    write_parquet(df_cleaned.repartition("year", "month"), parquet_path, partition_by=("year", "month"))
 
 
 if __name__ == "__main__":
@@ -190,5 +317,7 @@ if __name__ == "__main__":
     parser.add_argument("--year", type=int, required=True, help="Year to process, for example 2025")
     parser.add_argument("--abs_jump", type=float, default=500.0, help="Absolute day on day change threshold")
     parser.add_argument("--rel_jump", type=float, default=5.0, help="Relative day on day change threshold where 5.0 means 5x")
+    parser.add_argument("--engine", choices=["spark", "pandas"], default="spark",
+                        help="Run steps 2 to 4 in Spark, or entirely in pandas for a single small year")
     args = parser.parse_args()
-    run(args.year, args.abs_jump, args.rel_jump)
+    run(args.year, args.abs_jump, args.rel_jump, args.engine)
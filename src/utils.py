@@ -6,25 +6,40 @@ import os
 import re
 import time
 
+import pyarrow.parquet as pq
 from pyspark.sql import SparkSession, DataFrame
-from pyspark.sql.window import Window
-from pyspark.sql.functions import row_number, col, date_format, to_date
+from pyspark.sql import functions as F
+from pyspark.sql.functions import col, date_format, to_date
 
 
 def create_spark(
     app_name: str = "ETLApp",
     driver_memory: str = "4g",
     executor_memory: str = "4g",
-    shuffle_partitions: int = 8,
+    shuffle_partitions: Optional[int] = None,
     extra_confs: Optional[Dict[str, str]] = None,
 ) -> SparkSession:
-    """Create and return a configured SparkSession."""
+    """Create and return a configured SparkSession.
+
+    shuffle_partitions defaults to twice the local core count (at least 8);
+    adaptive query execution then coalesces small post-shuffle partitions.
+    """
+    if shuffle_partitions is None:
+        shuffle_partitions = max(8, (os.cpu_count() or 1) * 2)
     builder = (
         SparkSession.builder.appName(app_name)
         .config("spark.driver.memory", driver_memory)
         .config("spark.executor.memory", executor_memory)
         .config("spark.sql.shuffle.partitions", str(shuffle_partitions))
+        .config("spark.sql.adaptive.enabled", "true")
+        .config("spark.sql.adaptive.coalescePartitions.enabled", "true")
+        .config("spark.sql.adaptive.advisoryPartitionSizeInBytes", "64MB")
+        .config("spark.sql.adaptive.skewJoin.enabled", "true")
         .config("spark.sql.legacy.timeParserPolicy", "LEGACY")
+        .config("spark.sql.parquet.columnarReaderBatchSize", "8192")
+        .config("spark.sql.execution.arrow.pyspark.enabled", "true")
+        .config("spark.sql.execution.arrow.pyspark.fallback.enabled", "true")
+        .config("spark.sql.execution.arrow.maxRecordsPerBatch", "8192")
     )
     if extra_confs:
         for k, v in extra_confs.items():
@@ -83,22 +98,52 @@ def list_year_parquets(output_dir: Path | str = "output", prefix: str = "cleaned
     return sorted(root.glob(f"{prefix}*"))
 
 
-def write_parquet(df: DataFrame, path: Path | str, mode: str = "overwrite") -> None:
-    """Write a DataFrame to Parquet."""
-    df.write.mode(mode).parquet(str(path))
+def write_parquet(
+    df: DataFrame,
+    path: Path | str,
+    mode: str = "overwrite",
+    partition_by: Optional[Iterable[str]] = None,
+    compression: str = "zstd",
+    block_size: int = 64 * 1024 * 1024,
+) -> None:
+    """Write a DataFrame to Parquet with dictionary encoding and the given codec and row-group size."""
+    writer = (
+        df.write.mode(mode)
+        .option("compression", compression)
+        .option("parquet.block.size", str(block_size))
+        .option("parquet.enable.dictionary", "true")
+    )
+    if partition_by:
+        writer = writer.partitionBy(*partition_by)
+    writer.parquet(str(path))
     log(f"written parquet to {path}")
 
 
+def count_parquet_rows(path: Path | str) -> int:
+    """Count rows of a (possibly partitioned) Parquet folder from file footers only."""
+    return sum(pq.ParquetFile(f).metadata.num_rows for f in Path(path).rglob("*.parquet"))
+
+
 def deduplicate_by_keys(
     df: DataFrame,
     keys: Iterable[str] = ("ItemCode", "WhsCode", "RecordDate"),
     order_col: str = "OnHand",
     order_desc: bool = True,
 ) -> DataFrame:
-    """Keep a single row per key group using row_number over a window."""
-    order_by = col(order_col).desc() if order_desc else col(order_col).asc()
-    w = Window.partitionBy(*list(keys)).orderBy(order_by)
-    return df.withColumn("rn", row_number().over(w)).filter(col("rn") == 1).drop("rn")
+    """Keep a single row per key group, the one with the highest (or lowest) order_col.
+
+    Takes max/min of a struct led by order_col, so Spark combines partial
+    aggregates before the shuffle instead of sorting every key group.
+    """
+    keys = list(keys)
+    values = [order_col] + [c for c in df.columns if c not in keys and c != order_col]
+    pick = F.max if order_desc else F.min
+    return (
+        df.groupBy(*keys)
+        .agg(pick(F.struct(*values)).alias("_row"))
+        .select(*keys, *[col("_row").getField(c).alias(c) for c in values])
+        .select(*df.columns)
+    )
 
 
 def format_date_col(
@@ -128,3 +173,28 @@ def load_db_config_from_env(
         "password": env[password_var],
         "table": env.get(table_var, "dbo.z_Stock_History_2"),
     }
+
+
+def _odbc_braced(value: str) -> str:
+    """Quote an ODBC connection-string value so ; and } inside it are taken literally."""
+    return "{" + value.replace("}", "}}") + "}"
+
+
+def load_odbc_config_from_env(
+    odbc_var: str = "MSSQL_ODBC",
+    user_var: str = "MSSQL_USER",
+    password_var: str = "MSSQL_PASSWORD",
+    table_var: str = "MSSQL_TABLE",
+) -> Dict[str, str]:
+    """Read a pyodbc connection string and target table from environment variables."""
+    env = os.environ
+    missing = [v for v in (odbc_var, user_var, password_var) if not env.get(v)]
+    if missing:
+        raise KeyError(f"missing env vars: {', '.join(missing)}")
+    return {
+        "conn_str": (
+            f"{env[odbc_var].rstrip(';')};"
+            f"UID={_odbc_braced(env[user_var])};PWD={_odbc_braced(env[password_var])}"
+        ),
+        "table": env.get(table_var, "dbo.z_Stock_History_2"),
+    }
@@ -1,29 +1,103 @@
 # src/writer.py
+import argparse
+from datetime import date
 from pathlib import Path
+from typing import Iterable, List, Optional
+
 from dotenv import load_dotenv
-from utils import create_spark, load_db_config_from_env, log
+from pyspark.sql import DataFrame, Row
+from pyspark.sql import functions as F
+from utils import (
+    count_parquet_rows,
+    create_spark,
+    load_db_config_from_env,
+    load_odbc_config_from_env,
+    log,
+)
 
-def main() -> None:
-    project_root = Path(__file__).resolve().parents[1]
-    load_dotenv(project_root / ".env")
+JDBC_PARTITIONS = 8
+ODBC_BATCH_SIZE = 10000
 
-    spark = create_spark("WriteMSSQL")
-    df = spark.read.parquet(str(project_root / "output" / "final_cleaned_stock_parquet"))
-    log(f"loaded final dataframe with {df.count()} rows")
+def _insert_partition(rows: Iterable[Row], conn_str: str, table: str, columns: List[str]) -> None:
+    """Insert one Spark partition through pyodbc fast_executemany, committing once at the end."""
+    import pyodbc  # only the odbc engine needs the ODBC driver manager
 
+    sql = f"INSERT INTO {table} ({', '.join(f'[{c}]' for c in columns)}) VALUES ({', '.join('?' * len(columns))})"
+    conn = pyodbc.connect(conn_str, autocommit=False)
+    try:
+        cursor = conn.cursor()
+        cursor.fast_executemany = True
+        batch = []
+        for row in rows:
+            batch.append(tuple(row))
+            if len(batch) >= ODBC_BATCH_SIZE:
+                cursor.executemany(sql, batch)
+                batch.clear()
+        if batch:
+            cursor.executemany(sql, batch)
+        conn.commit()
+    finally:
+        conn.close()
+
+def _write_jdbc(df: DataFrame) -> str:
     db = load_db_config_from_env()
 
-    (df.write
+    # Batched inserts over a fixed number of connections, without per-row transactions
+    (df.repartition(JDBC_PARTITIONS).write
         .format("jdbc")
         .option("url", db["url"])
         .option("dbtable", db["table"])
         .option("user", db["user"])
         .option("password", db["password"])
         .option("driver", "com.microsoft.sqlserver.jdbc.SQLServerDriver")
+        .option("batchsize", "10000")
+        .option("numPartitions", str(JDBC_PARTITIONS))
+        .option("isolationLevel", "NONE")
+        .option("sendStringParametersAsUnicode", "false")
         .mode("append")
         .save()
     )
-    log(f"data written to {db['table']} in MSSQL")
+    return db["table"]
+
+def _write_odbc(df: DataFrame) -> str:
+    db = load_odbc_config_from_env()
+    conn_str, table, columns = db["conn_str"], db["table"], df.columns
+
+    # Bulk parameter arrays per partition instead of one prepared INSERT round trip per row
+    df.repartition(JDBC_PARTITIONS).foreachPartition(
+        lambda rows: _insert_partition(rows, conn_str, table, columns)
+    )
+    return table
+
+def main(record_date: Optional[date] = None, engine: str = "jdbc") -> None:
+    project_root = Path(__file__).resolve().parents[1]
+    load_dotenv(project_root / ".env")
+
+    spark = create_spark("WriteMSSQL")
+    final_path = project_root / "output" / "final_cleaned_stock_parquet"
+    df = spark.read.parquet(str(final_path))
+    if record_date is None:
+        log(f"loaded final dataframe with {count_parquet_rows(final_path)} rows")
+    else:
+        # Filtering on the partition columns lets Spark read only that month's directory
+        df = df.where(
+            (F.col("year") == record_date.year)
+            & (F.col("month") == record_date.month)
+            & (F.col("RecordDate") == F.lit(record_date))
+        )
+        log(f"restricted to RecordDate {record_date}")
+
+    # year and month are Parquet partition columns, not part of the table schema
+    df = df.drop("year", "month")
+
+    table = _write_odbc(df) if engine == "odbc" else _write_jdbc(df)
+    log(f"data written to {table} in MSSQL")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--date", type=date.fromisoformat, default=None,
+                        help="Only load this RecordDate, for example 2025-03-14")
+    parser.add_argument("--engine", choices=["jdbc", "odbc"], default="jdbc",
+                        help="jdbc uses Spark's JDBC writer, odbc bulk-inserts with pyodbc fast_executemany")
+    args = parser.parse_args()
+    main(args.date, args.engine)